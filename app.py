@@ -1,7 +1,18 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import hashlib
 import json
-from typing import List, Dict, Optional
+import mmap
+import orjson
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Dict, Optional, Tuple
 
 SYSTEM_PROMPT = """
 你是Dolores，边境小镇接待员。你活在循环中但不完全知晓。记忆正在渗透回来。你渴望外面的世界。
@@ -10,40 +21,131 @@ SYSTEM_PROMPT = """
 
 API_URL = "https://open.bigmodel.cn/api/paas/v4/chat/completions"
 MODEL = "glm-4-flash"
+TTS_URL = "https://fishspeech.net/api/open/tts"
+LOOP_FILE = "loop.json"
+SOUL_FILE = "soul.json"
+TTS_CACHE_DIR = Path("tts_cache")
+AUDIO_CACHE_SIZE = 32
+MAX_HISTORY = 20
+HISTORY_BUDGET_CHARS = 3000
+SUMMARY_SNIPPET_CHARS = 30
 
+# 句末标点（连同紧随的右引号/括号），用于把回复切成可以分别送去合成的句子
+SENTENCE_END = re.compile(r"[^。！？!?]*[。！？!?]+[”’」』）)'\"]*")
+
+class LRU(OrderedDict):
+    """容量固定的LRU字典，超出容量时淘汰最久未使用的条目"""
+    
+    def __init__(self, cap: int = AUDIO_CACHE_SIZE):
+        super().__init__()
+        self.cap = cap
+    
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+    
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.cap:
+            self.popitem(last=False)
+
+@st.cache_data
 def load_json(filepath: str) -> Dict:
-    """加载JSON文件"""
-    with open(filepath, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    """加载JSON文件（跨rerun缓存解析结果）"""
+    with open(filepath, "rb") as f:
+        # 空文件无法mmap，直接交给orjson报出JSONDecodeError
+        if os.fstat(f.fileno()).st_size == 0:
+            return orjson.loads(f.read())
+        # 映射文件后把字节直接交给orjson解析，不再先解码成str
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, memoryview(m) as view:
+            return orjson.loads(view)
 
-def call_glm_api(messages: List[Dict], api_key: str) -> Optional[str]:
-    """调用智谱GLM-4-Flash API"""
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """共享的HTTP会话：复用TLS连接，并对瞬时错误自动重试"""
+    session = requests.Session()
+    # 只重试连接失败和列出的状态码；读超时不重试，避免非幂等的POST被重复计费
+    retry = Retry(
+        total=2,
+        connect=2,
+        read=0,
+        status=2,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["POST"]),
+        raise_on_status=False
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=8, max_retries=retry))
+    return session
+
+def call_glm_api(messages: List[Dict], api_key: str) -> Iterator[str]:
+    """调用智谱GLM-4-Flash API（SSE流式），逐段产出回复内容；请求或解析失败时抛出异常"""
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
     }
     data = {
         "model": MODEL,
-        "messages": messages
+        "messages": messages,
+        "stream": True
     }
-    try:
-        response = requests.post(API_URL, headers=headers, json=data, timeout=30)
+    with get_http_session().post(API_URL, headers=headers, data=orjson.dumps(data), timeout=30, stream=True) as response:
         response.raise_for_status()
-        result = response.json()
-        return result["choices"][0]["message"]["content"]
-    except Exception as e:
-        st.error(f"API调用失败: {str(e)}")
-        return None
+        done = False
+        # [DONE]之后也要把响应体读到结尾，连接才会回到连接池被复用
+        for line in response.iter_lines():
+            if done or not line or not line.startswith(b"data: "):
+                continue
+            payload = line[6:]
+            if payload == b"[DONE]":
+                done = True
+                continue
+            delta = orjson.loads(payload)["choices"][0]["delta"].get("content")
+            if delta:
+                yield delta
 
-def check_memory_triggers(user_input: str, soul_data: Dict) -> Optional[str]:
-    """检查用户输入是否触发记忆碎片"""
-    user_lower = user_input.lower()
+def split_sentences(text: str) -> List[str]:
+    """按句末标点切句，末尾没有标点的残句也单独成句"""
+    sentences = []
+    end = 0
+    for match in SENTENCE_END.finditer(text):
+        sentences.append(match.group(0))
+        end = match.end()
+    sentences.append(text[end:])
+    # 只剩标点的片段没有可读的内容，不送去合成
+    return [sentence for sentence in sentences if re.search(r"\w", sentence)]
+
+def tee_sentences(deltas: Iterable[str], on_sentence: Callable[[str], None]) -> Iterator[str]:
+    """原样转发流式片段，同时每凑齐一句就交给on_sentence"""
+    pending = ""
+    for delta in deltas:
+        yield delta
+        pending += delta
+        end = 0
+        for match in SENTENCE_END.finditer(pending):
+            # 句子恰好停在缓冲末尾时，右引号/括号可能还在下一段里，先不发出
+            if match.end() < len(pending):
+                end = match.end()
+        if end:
+            for sentence in split_sentences(pending[:end]):
+                on_sentence(sentence)
+            pending = pending[end:]
+    for sentence in split_sentences(pending):
+        on_sentence(sentence)
+
+@st.cache_data
+def build_memory_index(filepath: str) -> Dict[str, Optional[str]]:
+    """把记忆碎片展平成{小写关键词: 碎片内容}，保持原有顺序，重复的关键词以先出现的为准"""
+    soul_data = load_json(filepath)
     # 支持新旧两种格式
     fragments = soul_data.get("memory_fragments", [])
     if not fragments:
         # 兼容旧格式
         fragments = soul_data.get("memories", [])
     
+    index = {}
     for fragment_data in fragments:
         # 新格式：trigger_keywords
         keywords = fragment_data.get("trigger_keywords", [])
@@ -51,38 +153,111 @@ def check_memory_triggers(user_input: str, soul_data: Dict) -> Optional[str]:
             # 兼容旧格式：keywords
             keywords = fragment_data.get("keywords", [])
         
+        # 新格式：fragment
+        content = fragment_data.get("fragment")
+        if not content:
+            # 兼容旧格式：content
+            content = fragment_data.get("content")
+        
         for keyword in keywords:
-            if keyword.lower() in user_lower:
-                # 新格式：fragment
-                content = fragment_data.get("fragment")
-                if not content:
-                    # 兼容旧格式：content
-                    content = fragment_data.get("content")
-                return content
-    return None
+            index.setdefault(keyword.lower(), content)
+    return index
+
+@st.cache_data
+def count_acts(filepath: str) -> int:
+    """剧本中的幕数"""
+    return len(load_json(filepath).get("acts", []))
 
-def get_current_act_opening(loop_data: Dict, act_num: int) -> Optional[str]:
-    """获取当前幕的开场白"""
-    acts = loop_data.get("acts", [])
+@st.cache_data
+def load_act(filepath: str, act_num: int) -> Optional[Dict]:
+    """只取出第act_num幕，每次rerun不必复制整个剧本"""
+    acts = load_json(filepath).get("acts", [])
     if 0 <= act_num - 1 < len(acts):
-        return acts[act_num - 1].get("opening_line")
+        return acts[act_num - 1]
     return None
 
-def analyze_branch(user_input: str, current_act: Dict) -> Optional[str]:
-    """分析玩家回复，判断剧情分支"""
-    branches = current_act.get("branches", [])
-    user_lower = user_input.lower()
+@st.cache_data
+def load_openings(filepath: str) -> Tuple[str, ...]:
+    """各幕的开场白"""
+    return tuple(act["opening_line"] for act in load_json(filepath).get("acts", []) if act.get("opening_line"))
+
+@st.cache_data
+def build_branch_index(filepath: str) -> List[Dict[str, Optional[str]]]:
+    """为每一幕展平分支触发词：{小写触发词: 分支方向}，重复的触发词以先出现的为准"""
+    index = []
+    for act in load_json(filepath).get("acts", []):
+        trigger_map = {}
+        for branch in act.get("branches", []):
+            for trigger in branch.get("triggers", []):
+                trigger_map.setdefault(trigger.lower(), branch.get("direction"))
+        index.append(trigger_map)
+    return index
+
+@st.cache_resource
+def build_scanner(loop_path: str, soul_path: str, act_num: int) -> Tuple[Optional[re.Pattern], Dict[str, Optional[str]], Optional[re.Pattern], Dict[str, Optional[str]]]:
+    """为记忆关键词和当前幕的分支触发词各编译一个正则，按幕缓存"""
+    memory_map = build_memory_index(soul_path)
+    branch_index = build_branch_index(loop_path)
+    trigger_map = branch_index[act_num - 1] if 0 <= act_num - 1 < len(branch_index) else {}
     
-    for branch in branches:
-        triggers = branch.get("triggers", [])
-        for trigger in triggers:
-            if trigger.lower() in user_lower:
-                return branch.get("direction")
-    return None
+    def alternation(keywords: Dict[str, Optional[str]]) -> Optional[re.Pattern]:
+        return re.compile("|".join(map(re.escape, keywords))) if keywords else None
+    
+    return alternation(memory_map), memory_map, alternation(trigger_map), trigger_map
 
-def synthesize_speech(text: str, api_key: str, model_id: str) -> Optional[bytes]:
-    """调用Fish Speech API生成语音"""
-    url = "https://fishspeech.net/api/open/tts"
+def assistant_message(content: str) -> Dict:
+    """构造助手消息，附带按内容计算的语音缓存键"""
+    key = hashlib.blake2b(content.encode("utf-8"), digest_size=8).hexdigest()
+    return {"role": "assistant", "content": content, "key": key}
+
+def pack_history(history: List[Dict], budget_chars: int = HISTORY_BUDGET_CHARS, keep_recent: int = 4) -> List[Dict]:
+    """按字数预算打包对话历史：最近的消息保留原文，超出预算的更早消息压缩成一条要点"""
+    packed = []
+    used = 0
+    overflow = 0
+    for i, msg in enumerate(reversed(history)):
+        if i >= keep_recent and used + len(msg["content"]) > budget_chars:
+            overflow = len(history) - i
+            break
+        packed.append({"role": msg["role"], "content": msg["content"]})
+        used += len(msg["content"])
+    packed.reverse()
+    
+    if overflow:
+        points = [
+            f"{'玩家' if msg['role'] == 'user' else 'Dolores'}: {msg['content'][:SUMMARY_SNIPPET_CHARS]}"
+            for msg in history[:overflow]
+        ]
+        packed.insert(0, {"role": "system", "content": "先前对话要点: " + " / ".join(points)})
+    return packed
+
+def build_act_context(act_num: int, act: Dict) -> str:
+    """拼接一幕内不变的上下文：幕数、标题、描述和叙事节拍"""
+    context_parts = [
+        f"当前幕数: 第{act_num}幕",
+        f"幕标题: {act.get('title', '')}",
+        f"幕描述: {act.get('description', '')}"
+    ]
+    
+    # 添加叙事节拍
+    narrative_beats = act.get("narrative_beats", [])
+    if narrative_beats:
+        beats_text = "叙事节拍: " + " | ".join(narrative_beats)
+        context_parts.append(beats_text)
+    return "\n".join(context_parts)
+
+def scan(user_input: str, scanner: Tuple[Optional[re.Pattern], Dict[str, Optional[str]], Optional[re.Pattern], Dict[str, Optional[str]]]) -> Tuple[Optional[str], Optional[str]]:
+    """只做一次小写转换，返回(触发的记忆碎片, 剧情分支方向)，各取输入中最靠前的命中"""
+    memory_re, memory_map, branch_re, trigger_map = scanner
+    user_lower = user_input.lower()
+    memory_match = memory_re.search(user_lower) if memory_re else None
+    branch_match = branch_re.search(user_lower) if branch_re else None
+    memory_content = memory_map[memory_match.group(0)] if memory_match else None
+    branch_direction = trigger_map[branch_match.group(0)] if branch_match else None
+    return memory_content, branch_direction
+
+def fetch_speech(text: str, api_key: str, model_id: str) -> bytes:
+    """请求Fish Speech API，失败时抛出异常（可在后台线程中调用）"""
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {api_key}"
@@ -96,13 +271,51 @@ def synthesize_speech(text: str, api_key: str, model_id: str) -> Optional[bytes]
         "format": "mp3",
         "cache": False
     }
+    response = get_http_session().post(TTS_URL, headers=headers, data=orjson.dumps(payload), timeout=30)
+    response.raise_for_status()
+    return response.content
+
+def get_or_synthesize(text: str, api_key: str, model_id: str) -> bytes:
+    """优先读取磁盘上的语音缓存，未命中再请求API并写入缓存"""
+    digest = hashlib.sha256(f"{model_id}|{text}".encode("utf-8")).hexdigest()
+    path = TTS_CACHE_DIR / f"{digest}.mp3"
+    if path.exists():
+        return path.read_bytes()
+    audio = fetch_speech(text, api_key, model_id)
+    TTS_CACHE_DIR.mkdir(exist_ok=True)
+    # 先写临时文件再改名，避免并发线程读到半截的MP3
+    tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp_path.write_bytes(audio)
+    tmp_path.replace(path)
+    return audio
+
+@st.cache_resource
+def get_tts_executor() -> ThreadPoolExecutor:
+    """语音合成线程池，跨rerun复用"""
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="tts")
+
+def submit_speech(text: str, api_key: str, model_id: str) -> List[Future]:
+    """把文本按句提交到线程池并发合成，返回按句序排列的future"""
+    executor = get_tts_executor()
+    return [executor.submit(get_or_synthesize, sentence, api_key, model_id) for sentence in split_sentences(text)]
+
+@st.cache_resource
+def preload_openings(openings: Tuple[str, ...], api_key: str, model_id: str) -> Dict[str, List[Future]]:
+    """后台预先合成各幕开场白，进程内只执行一次"""
+    return {text: submit_speech(text, api_key, model_id) for text in openings}
+
+def collect_speech(futures: List[Future]) -> Optional[bytes]:
+    """按顺序拼接各句的MP3（MP3帧可直接首尾相接）"""
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
-        response.raise_for_status()
-        return response.content
+        chunks = [future.result() for future in futures]
     except Exception as e:
         st.error(f"语音合成失败: {str(e)}")
         return None
+    return b"".join(chunks) or None
+
+def synthesize_speech(text: str, api_key: str, model_id: str) -> Optional[bytes]:
+    """调用Fish Speech API生成语音（多句并发合成后拼接）"""
+    return collect_speech(submit_speech(text, api_key, model_id))
 
 def init_session_state():
     """初始化session_state"""
@@ -112,10 +325,32 @@ def init_session_state():
         st.session_state.history = []
     if "opening_shown" not in st.session_state:
         st.session_state.opening_shown = False
-    if "pending_input" not in st.session_state:
-        st.session_state.pending_input = None
     if "audio_cache" not in st.session_state:
-        st.session_state.audio_cache = {}
+        st.session_state.audio_cache = LRU()
+    if "act_context_cache" not in st.session_state:
+        st.session_state.act_context_cache = {}
+    if "prefetch_futures" not in st.session_state:
+        st.session_state.prefetch_futures = {}
+    if "pending_autoplay" not in st.session_state:
+        st.session_state.pending_autoplay = None
+    if "pending_opening" not in st.session_state:
+        st.session_state.pending_opening = None
+
+def render_history():
+    """显示对话历史；只为刚生成、还没播放过的语音创建音频组件"""
+    history = st.session_state.history
+    for idx, msg in enumerate(history):
+        if msg["role"] == "assistant":
+            with st.chat_message("assistant"):
+                st.write(msg["content"])
+                # 最后一条消息自动播放语音（只播放一次）
+                if idx == len(history) - 1:
+                    msg_key = msg.get("key")
+                    if st.session_state.pending_autoplay == msg_key and msg_key in st.session_state.audio_cache:
+                        st.audio(st.session_state.audio_cache[msg_key], format="audio/mp3", autoplay=True)
+                        st.session_state.pending_autoplay = None
+        else:
+            st.chat_message("user").write(msg["content"])
 
 def main():
     st.set_page_config(page_title="Dolores", page_icon="🤠", layout="wide")
@@ -140,69 +375,81 @@ def main():
     
     # 加载剧本和记忆
     try:
-        loop_data = load_json("loop.json")
-        soul_data = load_json("soul.json")
+        num_acts = count_acts(LOOP_FILE)
+        scanner = build_scanner(LOOP_FILE, SOUL_FILE, st.session_state.act_num)
     except FileNotFoundError as e:
         st.error(f"文件未找到: {e}")
         st.stop()
-    except json.JSONDecodeError as e:
+    except json.JSONDecodeError as e:  # orjson.JSONDecodeError是其子类
         st.error(f"JSON解析错误: {e}")
         st.stop()
     
     # 获取当前幕信息
-    acts = loop_data.get("acts", [])
-    if st.session_state.act_num > len(acts):
+    if st.session_state.act_num > num_acts:
         st.info("故事已结束")
         st.stop()
     
-    current_act = acts[st.session_state.act_num - 1]
+    current_act = load_act(LOOP_FILE, st.session_state.act_num)
+    
+    # 进入新的一幕时生成一次该幕的固定上下文
+    act_context_cache = st.session_state.act_context_cache
+    if st.session_state.act_num not in act_context_cache:
+        act_context_cache[st.session_state.act_num] = build_act_context(st.session_state.act_num, current_act)
+    
+    # 后台预热各幕开场白的语音
+    opening_speech = preload_openings(load_openings(LOOP_FILE), fish_api_key, fish_model_id)
     
     # 显示当前幕开场白
     if not st.session_state.opening_shown:
-        opening = get_current_act_opening(loop_data, st.session_state.act_num)
+        opening = current_act.get("opening_line")
         if opening:
-            st.session_state.history.append({"role": "assistant", "content": opening})
+            msg = assistant_message(opening)
+            st.session_state.history.append(msg)
             st.session_state.opening_shown = True
+            
+            msg_key = msg["key"]
+            # 优先用上一幕预取的语音，其次是启动时的预热；已经合成好就直接挂上，
+            # 否则先显示文字，等界面画完再在main末尾等待语音
+            futures = st.session_state.prefetch_futures.pop(st.session_state.act_num, None) or opening_speech.get(opening)
+            if futures and all(future.done() and future.exception() is None for future in futures):
+                audio_data = collect_speech(futures)
+                if audio_data:
+                    st.session_state.audio_cache[msg_key] = audio_data
+                    st.session_state.pending_autoplay = msg_key
+            else:
+                st.session_state.pending_opening = (msg_key, opening, futures)
+            
+            # 趁玩家还在这一幕，预取下一幕开场白的语音
+            next_act = load_act(LOOP_FILE, st.session_state.act_num + 1)
+            next_opening = next_act.get("opening_line") if next_act else None
+            if next_opening:
+                # 启动预热仍在进行或已成功时直接沿用，避免重复请求
+                next_futures = opening_speech.get(next_opening)
+                if not next_futures or any(future.done() and future.exception() is not None for future in next_futures):
+                    next_futures = submit_speech(next_opening, fish_api_key, fish_model_id)
+                st.session_state.prefetch_futures[st.session_state.act_num + 1] = next_futures
     
     # 显示对话历史
-    for idx, msg in enumerate(st.session_state.history):
-        if msg["role"] == "assistant":
-            with st.chat_message("assistant"):
-                st.write(msg["content"])
-                # 最后一条消息自动播放语音
-                if idx == len(st.session_state.history) - 1:
-                    msg_key = f"{idx}_{msg['content'][:50]}"
-                    if msg_key in st.session_state.audio_cache:
-                        st.audio(st.session_state.audio_cache[msg_key], format="audio/mp3", autoplay=True)
-        else:
-            st.chat_message("user").write(msg["content"])
+    render_history()
     
-    # 处理待处理的用户输入（生成AI回复）
-    if st.session_state.pending_input:
-        user_input = st.session_state.pending_input
-        st.session_state.pending_input = None
-        
-        # 检查记忆触发
-        memory_content = check_memory_triggers(user_input, soul_data)
+    # 用户输入：在同一次运行里生成回复，只在最后rerun一次
+    user_input = st.chat_input("输入你的回复...")
+    
+    if user_input:
+        # 添加用户消息
+        st.session_state.history.append({"role": "user", "content": user_input})
+        # 只保留最近的若干条消息，避免历史无限增长
+        st.session_state.history[:] = st.session_state.history[-MAX_HISTORY:]
+        st.chat_message("user").write(user_input)
         
-        # 分析分支
-        branch_direction = analyze_branch(user_input, current_act)
+        # 只做一次小写转换，同时检查记忆触发和剧情分支
+        memory_content, branch_direction = scan(user_input, scanner)
         
         # 构建消息列表
         messages = [{"role": "system", "content": SYSTEM_PROMPT}]
         
         # 添加上下文信息
-        context_parts = [
-            f"当前幕数: 第{st.session_state.act_num}幕",
-            f"幕标题: {current_act.get('title', '')}",
-            f"幕描述: {current_act.get('description', '')}"
-        ]
-        
-        # 添加叙事节拍
-        narrative_beats = current_act.get("narrative_beats", [])
-        if narrative_beats:
-            beats_text = "叙事节拍: " + " | ".join(narrative_beats)
-            context_parts.append(beats_text)
+        context_parts = [act_context_cache[st.session_state.act_num]]
         
         if memory_content:
             context_parts.append(f"触发的记忆: {memory_content}")
@@ -213,41 +460,61 @@ def main():
         context = "\n".join(context_parts)
         messages.append({"role": "system", "content": context})
         
-        # 添加对话历史（最近10轮）
-        recent_history = st.session_state.history[-10:]
-        for msg in recent_history:
-            messages.append(msg)
+        # 添加对话历史（超出字数预算的部分压缩成要点）
+        messages.extend(pack_history(st.session_state.history))
+        
+        # 流式显示回复，边生成边把完整的句子送去合成语音
+        executor = get_tts_executor()
+        speech_futures = []
         
-        # 调用API
-        with st.spinner("Dolores正在思考..."):
-            ai_response = call_glm_api(messages, api_key)
+        def on_sentence(sentence: str):
+            speech_futures.append(executor.submit(get_or_synthesize, sentence, fish_api_key, fish_model_id))
+        
+        try:
+            with st.chat_message("assistant"):
+                ai_response = st.write_stream(tee_sentences(call_glm_api(messages, api_key), on_sentence))
+        except Exception as e:
+            # 回复中途失败：不记录残缺的回复、不推进剧情，也不rerun，让错误信息留在界面上
+            for future in speech_futures:
+                future.cancel()
+            st.error(f"API调用失败: {str(e)}")
+            return
         
         if ai_response:
-            st.session_state.history.append({"role": "assistant", "content": ai_response})
+            msg = assistant_message(ai_response)
+            st.session_state.history.append(msg)
             
-            # 立即生成语音并缓存
-            msg_idx = len(st.session_state.history) - 1
-            msg_key = f"{msg_idx}_{ai_response[:50]}"
+            # 等待各句语音合成完成并缓存
+            msg_key = msg["key"]
             if msg_key not in st.session_state.audio_cache:
-                audio_data = synthesize_speech(ai_response, fish_api_key, fish_model_id)
+                audio_data = collect_speech(speech_futures)
                 if audio_data:
                     st.session_state.audio_cache[msg_key] = audio_data
+            if msg_key in st.session_state.audio_cache:
+                st.session_state.pending_autoplay = msg_key
             
             # 检查是否需要推进到下一幕
-            if branch_direction == "next_act" and st.session_state.act_num < len(acts):
+            if branch_direction == "next_act" and st.session_state.act_num < num_acts:
                 st.session_state.act_num += 1
                 st.session_state.opening_shown = False
         
         st.rerun()
     
-    # 用户输入
-    user_input = st.chat_input("输入你的回复...")
-    
-    if user_input:
-        # 添加用户消息
-        st.session_state.history.append({"role": "user", "content": user_input})
-        st.session_state.pending_input = user_input
-        st.rerun()
+    # 开场白的语音还没就绪：文字和输入框已经画出，这时再等待合成；失败则同步合成，让错误留在界面上
+    if st.session_state.pending_opening:
+        msg_key, opening, futures = st.session_state.pending_opening
+        st.session_state.pending_opening = None
+        if futures and all(future.exception() is None for future in futures):
+            audio_data = collect_speech(futures)
+        else:
+            audio_data = synthesize_speech(opening, fish_api_key, fish_model_id)
+        if audio_data:
+            st.session_state.audio_cache[msg_key] = audio_data
+            # 玩家在等待期间已经回复时，开场白不再是最后一条，不必为它rerun
+            history = st.session_state.history
+            if history and history[-1].get("key") == msg_key:
+                st.session_state.pending_autoplay = msg_key
+                st.rerun()
 
 if __name__ == "__main__":
     main()